@@ -1,8 +1,19 @@
 # app.py
 
+import csv
+import hashlib
+import io
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+import orjson
+from PIL import Image, ImageOps
 import streamlit as st
-import pandas as pd
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util import Retry
 
 # --- Basic App Configuration ---
 st.set_page_config(page_title="Reliable Marketing AI Generator", layout="wide")
@@ -10,39 +21,222 @@ st.title("🎯 Reliable Marketing Content AI")
 st.header("Turn a simple description of your image into SEO-rich marketing content.")
 st.info("✅ **This version is stable.** It no longer depends on unreliable AI vision models.")
 
-# --- API Call for the "Marketing Brain" (Stable Text AI) ---
-def generate_marketing_content(api_key: str, prompt: str) -> (bool, str):
-    """Calls a powerful and stable text model to generate all marketing content."""
-    # This is a flagship, highly reliable instruction-following model.
-    API_URL = "https://api-inference.huggingface.co/models/mistralai/Mistral-7B-Instruct-v0.2"
+# --- Shared HTTP Session ---
+@st.cache_resource
+def get_http_session(retry_cold_models: bool = True) -> requests.Session:
+    """Returns one keep-alive session per server process so TLS connections are reused across reruns.
+
+    With retry_cold_models=False, 502/503/504 come straight back to the caller; the model fallback ladder needs that."""
+    # Retry the "model loading" / gateway errors with exponential backoff instead of asking the user to click again.
+    # raise_on_status=False hands the last 503 back to us so the friendly message below still works.
+    # Read timeouts are not retried (read=False): they surface as ReadTimeout so the caller can fall back to another model.
+    status_forcelist = [502, 503, 504] if retry_cold_models else []
+    retry = Retry(total=5, read=False, backoff_factor=2, status_forcelist=status_forcelist, allowed_methods=["POST"], raise_on_status=False)
+    adapter = HTTPAdapter(pool_connections=16, pool_maxsize=16, max_retries=retry)
+    session = requests.Session()
+    session.mount("https://", adapter)
+    # Bodies are pre-serialised with orjson and sent as data=, so declare the JSON content type here once.
+    session.headers.update({"Connection": "keep-alive", "Accept-Encoding": "gzip", "Content-Type": "application/json"})
+    return session
+
+# --- Response Cache ---
+RESPONSE_CACHE_TTL = 3600  # seconds
+RESPONSE_CACHE_MAX_ENTRIES = 256
+
+@st.cache_resource
+def get_response_cache() -> (OrderedDict, threading.Lock):
+    """Process-wide LRU of sha256(prompt) -> (timestamp, generated content, model id), with the lock guarding it.
+
+    Every session runs its script in its own thread, so all reads and writes must hold the lock."""
+    return OrderedDict(), threading.Lock()
+
+def get_cached_response(prompt: str):
+    """Returns the cached (content, model id) for this exact prompt, or None if missing or expired."""
+    cache, lock = get_response_cache()
+    key = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    with lock:
+        entry = cache.get(key)
+        if entry and time.time() - entry[0] < RESPONSE_CACHE_TTL:
+            cache.move_to_end(key)
+            return entry[1], entry[2]
+    return None
+
+def store_cached_response(prompt: str, content: str, model_id: str):
+    cache, lock = get_response_cache()
+    key = hashlib.sha256(prompt.encode("utf-8")).hexdigest()
+    now = time.time()
+    with lock:
+        # Drop expired entries, then the least recently used ones, so the cache can't grow without bound
+        for expired in [k for k, entry in cache.items() if now - entry[0] >= RESPONSE_CACHE_TTL]:
+            del cache[expired]
+        cache[key] = (now, content, model_id)
+        cache.move_to_end(key)
+        while len(cache) > RESPONSE_CACHE_MAX_ENTRIES:
+            cache.popitem(last=False)
+
+# --- Semantic Cache (near-duplicate descriptions) ---
+SEMANTIC_CACHE_THRESHOLD = 0.92
+EMBEDDING_DIM = 384  # all-MiniLM-L6-v2 sentence embedding size
+EMBEDDING_API_URL = "https://api-inference.huggingface.co/pipeline/feature-extraction/sentence-transformers/all-MiniLM-L6-v2"
+
+def get_description_embedding(api_key: str, text: str):
+    """Embeds the user description with a small sentence-transformer; returns None on any failure."""
     headers = {"Authorization": f"Bearer {api_key}"}
     try:
-        response = requests.post(API_URL, headers=headers, json={"inputs": prompt, "parameters": {"max_new_tokens": 1024}}, timeout=60)
-        if response.status_code == 200:
-            result = response.json()
-            # Clean the output to remove the prompt that the model sometimes repeats
-            content = result[0].get('generated_text', '').replace(prompt, '').strip()
-            return True, content
-        if response.status_code == 503:
-            return False, "The AI Marketing model is starting up. This can take up to a minute. Please try again."
-        return False, f"AI Marketing Model Error (Code {response.status_code}): {response.text}"
-    except Exception as e:
-        return False, f"An error occurred with the AI Marketing model: {str(e)}"
-
-# --- Prompt Engineering Function ---
-def create_final_prompt(platform: str, user_description: str, add_cta: bool, cta_text: str):
-    """Creates the detailed instruction prompt for the text AI based on user input."""
-    # This special formatting (`[INST]...[/INST]`) is the correct way to instruct the Mistral model.
-    base_instructions = f"""[INST] You are a world-class digital marketing and SEO expert. Your task is to generate compelling metadata for an image.
-THE USER DESCRIBES THE IMAGE AS: "{user_description}"
+        # This lookup only saves time if it is quick: no retries on a cold model and a short read budget.
+        response = get_http_session(retry_cold_models=False).post(EMBEDDING_API_URL, headers=headers, data=orjson.dumps({"inputs": text}), timeout=(3, 5))
+        if response.status_code != 200:
+            return None
+        vector = np.asarray(orjson.loads(response.content), dtype=np.float32)
+        # Only a pooled sentence vector is comparable; token-level or batched replies are ignored.
+        if vector.shape != (EMBEDDING_DIM,):
+            return None
+        norm = np.linalg.norm(vector)
+        return vector / norm if norm else None
+    except Exception:
+        return None
+
+def has_similar_candidates(settings_key: tuple) -> bool:
+    """True if this session has earlier results with the same platform/CTA settings, i.e. a semantic hit is possible."""
+    return any(e[1] == settings_key for e in st.session_state.get("semantic_cache", []))
+
+def find_similar_content(embedding, settings_key: tuple):
+    """Returns (earlier description, content) for a near-identical description with the same platform/CTA settings."""
+    entries = [e for e in st.session_state.get("semantic_cache", []) if e[1] == settings_key]
+    if embedding is None or not entries:
+        return None
+    scores = np.stack([e[0] for e in entries]) @ embedding
+    best = int(np.argmax(scores))
+    return entries[best][2:] if scores[best] >= SEMANTIC_CACHE_THRESHOLD else None
+
+def remember_content(embedding, settings_key: tuple, description: str, content: str):
+    if embedding is not None:
+        st.session_state.setdefault("semantic_cache", []).append((embedding, settings_key, description, content))
 
-Based on the user's description, follow the instructions for the specified platform below.
+# --- API Call for the "Marketing Brain" (Stable Text AI) ---
+STREAM_REFRESH_EVERY = 8  # tokens between placeholder redraws
+
+def read_token_stream(response, placeholder) -> (bool, str):
+    """Collects tokens from a text-generation SSE stream, redrawing the placeholder as they arrive."""
+    buffer = ""
+    token_count = 0
+    for line in response.iter_lines():
+        if not line.startswith(b"data:"):
+            continue
+        try:
+            event = orjson.loads(line[len(b"data:"):])
+        except orjson.JSONDecodeError:
+            continue  # e.g. a "data: [DONE]" terminator
+        if "error" in event:
+            return False, f"AI Marketing Model Error: {event['error']}"
+        token = event.get("token") or {}
+        if token.get("special") or not token.get("text"):
+            continue
+        buffer += token["text"]
+        token_count += 1
+        if placeholder is not None and token_count % STREAM_REFRESH_EVERY == 0:
+            placeholder.code(buffer, language='markdown')
+    return True, buffer.strip()
+
+# Tried in order: a fast model on a tight read budget first, then a larger one with more patience.
+MARKETING_MODELS = [
+    ("mistralai/Mistral-7B-Instruct-v0.2", 15),
+    ("mistralai/Mixtral-8x7B-Instruct-v0.1", 90),
+]
+
+# Generation time grows with output length, so each platform only gets room for what its format needs.
+MAX_TOKENS = {"Microstock": 450, "Pinterest": 300, "Facebook": 250, "Instagram": 200, "LinkedIn": 350, "X (Twitter)": 180}
+
+def generate_marketing_content(api_key: str, prompt: str, placeholder=None, models=MARKETING_MODELS, max_new_tokens: int = 1024, fresh: bool = False) -> (bool, str, str):
+    """Calls a powerful and stable text model to generate all marketing content, streaming it into `placeholder`.
+
+    With fresh=True the server-side cache is bypassed and sampling is enabled, so a repeated prompt gets new text.
+    Returns (success, content, model id that produced it)."""
+    headers = {"Authorization": f"Bearer {api_key}", "Accept": "text/event-stream"}
+    if fresh:
+        parameters = {"max_new_tokens": max_new_tokens, "return_full_text": False, "do_sample": True, "temperature": 0.7}
+    else:
+        # Greedy decoding keeps outputs reproducible, which is what makes the response cache meaningful.
+        parameters = {"max_new_tokens": max_new_tokens, "return_full_text": False, "do_sample": False}
+    payload = {"inputs": prompt, "parameters": parameters, "options": {"use_cache": not fresh}, "stream": True}
+    error = ""
+    for model_id, read_budget in models:
+        API_URL = f"https://api-inference.huggingface.co/models/{model_id}"
+        try:
+            # (connect, read) timeouts: the read budget applies between streamed chunks, not to the whole generation.
+            # No status retries here: a cold model's 503 should move us to the next model right away.
+            with get_http_session(retry_cold_models=False).post(API_URL, headers=headers, data=orjson.dumps(payload), stream=True, timeout=(5, read_budget)) as response:
+                if response.status_code == 200:
+                    if response.headers.get("Content-Type", "").startswith("text/event-stream"):
+                        success, content = read_token_stream(response, placeholder)
+                        if not success:
+                            return False, content, model_id
+                    else:
+                        # Models that don't support streaming answer with the usual JSON body
+                        result = orjson.loads(response.content)
+                        # Clean the output: when the model echoes the prompt, it is always as a prefix
+                        text = result[0].get('generated_text', '')
+                        content = (text[len(prompt):] if text.startswith(prompt) else text).strip()
+                    if not content:
+                        # An empty reply is a failed generation: try the next model and never cache it
+                        error = f"The AI Marketing model ({model_id}) returned no content. Please try again."
+                        continue
+                    store_cached_response(prompt, content, model_id)
+                    return True, content, model_id
+                if response.status_code in (503, 504):
+                    # Cold or overloaded: move on to the next model instead of failing
+                    error = "The AI Marketing model is starting up. This can take up to a minute. Please try again."
+                    continue
+                return False, f"AI Marketing Model Error (Code {response.status_code}): {response.text}", model_id
+        except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+            error = f"The AI Marketing model did not answer in time: {str(e)}"
+        except Exception as e:
+            return False, f"An error occurred with the AI Marketing model: {str(e)}", model_id
+    return False, error, ""
+
+# --- Model Warm-up ---
+def warm_up_models(api_key: str, session: requests.Session):
+    """Sends a tiny request to every model so cold starts happen before the user clicks Generate."""
+    headers = {"Authorization": f"Bearer {api_key}"}
+    payload = {"inputs": "hi", "parameters": {"max_new_tokens": 1}, "options": {"wait_for_model": True}}
+    requests_to_send = [(f"https://api-inference.huggingface.co/models/{model_id}", payload) for model_id, _ in MARKETING_MODELS]
+    requests_to_send.append((EMBEDDING_API_URL, {"inputs": "hi", "options": {"wait_for_model": True}}))
+    for url, body in requests_to_send:
+        try:
+            session.post(url, headers=headers, data=orjson.dumps(body), timeout=(5, 120))
+        except Exception:
+            pass  # Best effort only; the real request reports any problem.
+
+# --- Image Preview ---
+PREVIEW_WIDTH = 300
+
+def get_preview_thumbnail(image_bytes: bytes) -> bytes:
+    """Returns a small JPEG (PNG if transparent) of the upload, built once per image and kept in session state across reruns."""
+    digest = hashlib.sha256(image_bytes).hexdigest()
+    thumbnails = st.session_state.setdefault("thumbnails", {})
+    if digest not in thumbnails:
+        # Apply the EXIF orientation first; re-encoding drops the tag, so phone portraits would show rotated
+        thumb = ImageOps.exif_transpose(Image.open(io.BytesIO(image_bytes)))
+        thumb.thumbnail((PREVIEW_WIDTH, thumb.height))
+        buf = io.BytesIO()
+        if thumb.mode in ("RGBA", "LA") or (thumb.mode == "P" and "transparency" in thumb.info):
+            thumb.save(buf, "PNG", optimize=True)
+        else:
+            thumb.convert("RGB").save(buf, "JPEG", quality=85, optimize=True)
+        thumbnails[digest] = buf.getvalue()
+    return thumbnails[digest]
+
+# --- Prompt Engineering ---
+# Each prompt is a fixed instruction block followed by a short per-request suffix.
+# Keeping everything that never changes at the front lets the inference backend reuse its prompt/KV cache across requests.
+# This special formatting (`[INST]...[/INST]`) is the correct way to instruct the Mistral model.
+BASE_INSTRUCTIONS = """[INST] You are a world-class digital marketing and SEO expert. Your task is to generate compelling metadata for an image.
+The image description, target platform and any Call-to-Action are given at the end of these instructions.
+Follow the instructions for the specified platform below.
 ---
-PLATFORM: {platform}
 """
 
-    if platform == "Microstock":
-        prompt = base_instructions + """
+MICROSTOCK_PREFIX = BASE_INSTRUCTIONS + """
 Task 1: Generate two highly optimized, SEO-rich titles (under 200 characters each). Make them commercial-friendly and keyword-rich.
 Task 2: Generate 49 relevant, comma-separated keywords (all lowercase). Prioritize the most important keywords first. Include a mix of single and double-word keywords.
 Task 3: Suggest one ideal category for Adobe Stock and up to two for Shutterstock.
@@ -66,13 +260,11 @@ Provide the output EXACTLY in this format, with no extra text or explanations:
 
 ### Shutterstock Categories
 [Category 1, Category 2]
-[/INST]"""
+"""
 
-    elif platform == "Pinterest":
-        cta_instruction = f"IMPORTANT: Naturally integrate this Call-to-Action in the description: '{cta_text}'" if add_cta else ""
-        prompt = base_instructions + f"""
+PINTEREST_PREFIX = BASE_INSTRUCTIONS + """
 Task 1: Generate a catchy, SEO-friendly Pin Title (max 100 chars).
-Task 2: Generate an engaging Pin Description (max 500 chars) with 3-5 relevant hashtags at the end. {cta_instruction}
+Task 2: Generate an engaging Pin Description (max 500 chars) with 3-5 relevant hashtags at the end. If a CTA is given, naturally integrate it in the description.
 Task 3: Suggest a relevant, descriptive Alt Tag.
 Task 4: Suggest a relevant Pinterest Board Name.
 
@@ -92,14 +284,13 @@ Provide the output EXACTLY in this format, with no extra text or explanations:
 
 ### Suggested Board Name
 [Board name]
-[/INST]"""
-    else: # Facebook, Instagram, LinkedIn, X
-        cta_instruction = f"IMPORTANT: Seamlessly include this Call-to-Action in the post: '{cta_text}'" if add_cta else ""
-        prompt = base_instructions + f"""
+"""
+
+SOCIAL_PREFIX = BASE_INSTRUCTIONS + """
 Task 1: Write an engaging and high-converting caption for the post. For Facebook/LinkedIn, make it more detailed. For Instagram/X, keep it concise and impactful.
 Task 2: Generate 5-10 highly relevant hashtags.
 
-{cta_instruction}
+If a CTA is given, seamlessly include it in the post.
 
 Provide the output EXACTLY in this format, with no extra text or explanations:
 
@@ -111,9 +302,27 @@ Provide the output EXACTLY in this format, with no extra text or explanations:
 
 ### Hashtags
 [#hashtag1, #hashtag2]
+"""
+
+# Only this short tail differs between requests; it goes after the static prefix.
+PROMPT_SUFFIX = """---
+PLATFORM: {platform}
+THE USER DESCRIBES THE IMAGE AS: "{desc}"{cta}
 [/INST]"""
 
-    return prompt
+TEMPLATES = {
+    "Microstock": MICROSTOCK_PREFIX + PROMPT_SUFFIX.replace("{cta}", ""),  # Microstock metadata never carries a CTA
+    "Pinterest": PINTEREST_PREFIX + PROMPT_SUFFIX,
+    "_default": SOCIAL_PREFIX + PROMPT_SUFFIX,  # Facebook, Instagram, LinkedIn, X
+}
+
+def create_final_prompt(platform: str, user_description: str, add_cta: bool, cta_text: str):
+    """Creates the detailed instruction prompt for the text AI based on user input."""
+    return TEMPLATES.get(platform, TEMPLATES["_default"]).format_map({
+        "platform": platform,
+        "desc": user_description,
+        "cta": f"\nCTA: '{cta_text}'" if add_cta else "",
+    })
 
 # --- Sidebar ---
 with st.sidebar:
@@ -123,12 +332,17 @@ with st.sidebar:
         st.warning("Please add your Hugging Face API Token to the app's secrets.")
     else:
         st.success("Hugging Face API Token loaded!")
+        # Once per session, wake the models up in the background while the user fills in the form
+        if not st.session_state.get("warmed"):
+            st.session_state["warmed"] = True
+            threading.Thread(target=warm_up_models, args=(hf_api_key, get_http_session()), daemon=True).start()
 
     platform = st.selectbox("1. Select Target Platform:", ("Microstock", "Pinterest", "Facebook", "Instagram", "LinkedIn", "X (Twitter)"))
     add_cta = st.checkbox("2. Add a Call-to-Action (CTA)?")
     cta_text = ""
     if add_cta:
         cta_text = st.text_input("Enter your CTA text/link", "Visit our website for more!")
+    force_regenerate = st.checkbox("3. Always generate fresh content (ignore earlier results)")
 
 # --- Main App Area ---
 st.markdown("### Step 1: Upload Your Image (For Your Reference)")
@@ -136,7 +350,8 @@ uploaded_file = st.file_uploader("Upload your image here", type=["png", "jpg", "
 
 user_description = ""
 if uploaded_file:
-    st.image(uploaded_file, caption="Your uploaded image", width=300)
+    # Every keystroke in the description reruns the script; show a pre-shrunk copy instead of re-decoding the original
+    st.image(get_preview_thumbnail(uploaded_file.getvalue()), caption="Your uploaded image", width=PREVIEW_WIDTH)
     st.markdown("### Step 2: Describe Your Image")
     user_description = st.text_area(
         "Write a simple, one-sentence description of the main subject and theme of your image.",
@@ -156,22 +371,45 @@ if generate_button:
         with st.spinner("🧠 The AI Marketing Brain is working... This may take a moment."):
             # Create the final prompt for the AI
             final_prompt = create_final_prompt(platform, user_description, add_cta, cta_text)
-            
-            # Call the AI to get the marketing content
-            success, final_content = generate_marketing_content(hf_api_key, final_prompt)
-            
+
+            # The same platform/description/CTA always renders the same prompt, so a repeat click is free.
+            settings_key = (platform, add_cta, cta_text)
+            success, embedding = False, None
+            cached = None if force_regenerate else get_cached_response(final_prompt)
+            if cached is not None:
+                success, (final_content, model_id) = True, cached
+            elif not force_regenerate and has_similar_candidates(settings_key):
+                # Reuse an earlier result if this description is just a light rewording of one we already generated
+                embedding = get_description_embedding(hf_api_key, user_description)
+                similar = find_similar_content(embedding, settings_key)
+                if similar is not None:
+                    earlier_description, final_content = similar
+                    success, model_id = True, "an earlier, near-identical request"
+                    st.info(f'♻️ Reusing the result for your earlier description: "{earlier_description}". '
+                            'Tick "Always generate fresh content" in the sidebar to generate new content instead.')
+
+            generated = not success
+            if generated:
+                # Call the AI to get the marketing content, showing tokens as they are generated
+                stream_placeholder = st.empty()
+                success, final_content, model_id = generate_marketing_content(
+                    hf_api_key, final_prompt, stream_placeholder,
+                    max_new_tokens=MAX_TOKENS.get(platform, 1024), fresh=force_regenerate)
+                stream_placeholder.empty()
+
             if success:
                 st.balloons()
                 st.subheader("✅ Generated Content:")
                 # Using st.code makes it easy for the user to copy the entire block
                 st.code(final_content, language='markdown')
+                st.caption(f"Generated by {model_id}")
 
                 # Prepare for CSV download
-                csv_data = pd.DataFrame([{
-                    "user_description": user_description,
-                    "platform": platform,
-                    "generated_content": final_content
-                }]).to_csv(index=False).encode('utf-8')
+                buf = io.StringIO()
+                writer = csv.writer(buf)
+                writer.writerow(["user_description", "platform", "generated_content"])
+                writer.writerow([user_description, platform, final_content])
+                csv_data = buf.getvalue().encode('utf-8')
 
                 st.download_button(
                     label="📥 Download Result as CSV",
@@ -180,5 +418,11 @@ if generate_button:
                     mime='text/csv',
                     use_container_width=True
                 )
+
+                # Index new results for near-duplicate reuse only after they are on screen, so embedding never delays them
+                if generated:
+                    if embedding is None:
+                        embedding = get_description_embedding(hf_api_key, user_description)
+                    remember_content(embedding, settings_key, user_description, final_content)
             else:
                 st.error(f"A problem occurred. The AI said: {final_content}")